@@ -1,37 +1,356 @@
 from langchain.vectorstores import FAISS
 from langchain.docstore.document import Document
 
-from typing import Tuple, List
+from typing import Tuple, List, Dict, Optional
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import hashlib
+import math
 import os
+import pickle
+import threading
+
+import faiss
+import numpy as np
 
 from pathlib import Path
+from weakref import WeakKeyDictionary
 
 from log_factory import logger
-from doc_loader import load_txt
+from doc_loader import load_txt, list_txt_files
 from config import cfg
 
+EMBEDDING_CACHE_VECTORS_FILE = "vectors.npy"
+EMBEDDING_CACHE_HASHES_FILE = "hashes.txt"
+RERANK_CODES_FILE = "rerank_codes.npy"
+RERANK_SCALES_FILE = "rerank_scales.npy"
+
+_rerank_lock = threading.Lock()
+_rerank_vectors: "WeakKeyDictionary[FAISS, Tuple[np.ndarray, np.ndarray]]" = (
+    WeakKeyDictionary()
+)
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def embedding_cache_dir() -> Path:
+    """
+    Returns the directory caching the vectors of the current embeddings model.
+    """
+    model = getattr(cfg.embeddings, "model", None) or getattr(
+        cfg.embeddings, "model_name", "default"
+    )
+    return cfg.embedding_cache_directory / model.replace("/", "_")
+
+
+def load_embedding_cache() -> Dict[str, np.ndarray]:
+    """
+    Reads the vectors of the texts embedded by earlier builds.
+    :return: the vectors keyed by the SHA-1 hash of their text.
+    """
+    cache_dir = embedding_cache_dir()
+    vectors_file = cache_dir / EMBEDDING_CACHE_VECTORS_FILE
+    hashes_file = cache_dir / EMBEDDING_CACHE_HASHES_FILE
+    if not (vectors_file.exists() and hashes_file.exists()):
+        return {}
+    with open(hashes_file) as f:
+        hashes = f.read().split()
+    return dict(zip(hashes, np.load(vectors_file)))
+
+
+def save_embedding_cache(embedding_cache: Dict[str, np.ndarray]):
+    """
+    Writes the cached vectors, so that the next build only embeds new or changed texts.
+    :param embedding_cache: The vectors keyed by the SHA-1 hash of their text.
+    """
+    cache_dir = embedding_cache_dir()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    hashes = list(embedding_cache)
+    np.save(
+        cache_dir / EMBEDDING_CACHE_VECTORS_FILE,
+        np.array([embedding_cache[h] for h in hashes], dtype=np.float32),
+    )
+    with open(cache_dir / EMBEDDING_CACHE_HASHES_FILE, "w") as f:
+        f.write("\n".join(hashes))
+    logger.info("Cached %d embeddings in %s", len(hashes), cache_dir)
+
+
+def build_batch_index(
+    texts: List[Document], embedding_cache: Dict[str, np.ndarray]
+) -> Tuple[FAISS, Dict[str, List[float]]]:
+    """
+    Embeds a batch of texts and builds a vector database for them.
+    Only the texts missing from the embedding cache are sent to the embeddings model.
+    :param texts: A batch of at most cfg.embedding_batch_size texts.
+    :param embedding_cache: The vectors of the texts embedded before, keyed by the SHA-1 hash of their text.
+    :return a vector database wrapper around the embeddings and the new vectors keyed by text hash.
+    """
+    contents = [t.page_content for t in texts]
+    hashes = [content_hash(c) for c in contents]
+    missing = {h: c for h, c in zip(hashes, contents) if h not in embedding_cache}
+    new_vectors = {}
+    if missing:
+        new_vectors = dict(
+            zip(missing, cfg.embeddings.embed_documents(list(missing.values())))
+        )
+    vectors = [
+        new_vectors[h] if h in new_vectors else embedding_cache[h] for h in hashes
+    ]
+    docsearch = FAISS.from_embeddings(
+        list(zip(contents, vectors)),
+        cfg.embeddings,
+        metadatas=[t.metadata for t in texts],
+    )
+    return docsearch, new_vectors
+
+
+def to_hnsw_index(vectors: np.ndarray) -> faiss.Index:
+    """
+    Builds an HNSW graph index, which answers searches in sub-linear time.
+    :param vectors: The normalized vectors in docstore order.
+    """
+    hnsw_index = faiss.IndexHNSWFlat(
+        vectors.shape[1], cfg.faiss_hnsw_m, faiss.METRIC_INNER_PRODUCT
+    )
+    hnsw_index.hnsw.efConstruction = cfg.faiss_hnsw_ef_construction
+    hnsw_index.hnsw.efSearch = cfg.faiss_hnsw_ef_search
+    hnsw_index.add(vectors)
+    return hnsw_index
+
+
+def to_ivfpq_index(vectors: np.ndarray) -> faiss.Index:
+    """
+    Builds an inverted file index with product quantized vectors, which is many times smaller
+    than the raw float32 vectors on disk and in memory.
+    :param vectors: The normalized vectors in docstore order, also used to train the quantizers.
+    """
+    n, d = vectors.shape
+    quantizer = faiss.IndexFlatIP(d)
+    ivfpq_index = faiss.IndexIVFPQ(
+        quantizer,
+        d,
+        int(math.sqrt(n)),
+        cfg.faiss_pq_m,
+        cfg.faiss_pq_nbits,
+        faiss.METRIC_INNER_PRODUCT,
+    )
+    ivfpq_index.train(vectors)
+    ivfpq_index.add(vectors)
+    ivfpq_index.nprobe = cfg.faiss_ivf_nprobe
+    return ivfpq_index
+
+
+def build_search_index(vectors: np.ndarray) -> faiss.Index:
+    """
+    Builds the index type configured in cfg.faiss_index_type.
+    All index types rank by inner product, which is the cosine similarity of the normalized vectors.
+    The vectors keep their order, so the docstore mapping stays valid.
+    :param vectors: The normalized vectors in docstore order.
+    """
+    if cfg.faiss_index_type == "flat":
+        flat_index = faiss.IndexFlatIP(vectors.shape[1])
+        flat_index.add(vectors)
+        return flat_index
+    if cfg.faiss_index_type == "sq8":
+        sq_index = faiss.IndexScalarQuantizer(
+            vectors.shape[1],
+            faiss.ScalarQuantizer.QT_8bit,
+            faiss.METRIC_INNER_PRODUCT,
+        )
+        sq_index.train(vectors)
+        sq_index.add(vectors)
+        return sq_index
+    if cfg.faiss_index_type == "ivfpq":
+        if len(vectors) >= cfg.faiss_ivfpq_min_vectors:
+            return to_ivfpq_index(vectors)
+        logger.warning(
+            "Only %d vectors, too few to train IVF-PQ. Using HNSW.", len(vectors)
+        )
+    return to_hnsw_index(vectors)
+
+
+def _has_persisted(p: Path) -> bool:
+    return p.exists() and any(p.iterdir())
+
+
+def quantize_vectors(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Quantizes each vector to int8 with its own scale, a quarter of the float32 size.
+    :param vectors: The float32 vectors.
+    :return: the int8 codes and the float16 scale of each vector.
+    """
+    max_abs = np.abs(vectors).max(axis=1)
+    scales = (127 / np.where(max_abs > 0, max_abs, 1)).astype(np.float16)
+    codes = np.clip(np.round(vectors * scales[:, None].astype(np.float32)), -127, 127)
+    return codes.astype(np.int8), scales
+
+
+def is_pq_coded(index: faiss.Index) -> bool:
+    """
+    Tells whether the index scores with product quantization codes, whose distances are too coarse
+    to rank the top results without re-ranking.
+    """
+    return isinstance(faiss.downcast_index(index), (faiss.IndexIVFPQ, faiss.IndexPQ))
+
+
+def reconstruct_rerank_vectors(index: faiss.Index) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Quantizes the vectors reconstructed from the index, for stores persisted without their re-rank vectors.
+    IVF indexes get a direct map for this, so it has to happen before the index is searched.
+    :param index: The faiss index.
+    :return: the int8 codes and the float16 scale of each vector.
+    """
+    ivf_index = faiss.try_extract_index_ivf(index)
+    if ivf_index is not None:
+        ivf_index.make_direct_map()
+    return quantize_vectors(index.reconstruct_n(0, index.ntotal))
+
+
+def rerank_candidates(docsearch: FAISS, ids: np.ndarray) -> np.ndarray:
+    """
+    Returns the vectors of the search candidates, used to re-rank the candidates of product quantized indexes
+    by their distance to the query.
+    The vectors are kept as int8 codes, which are built with the vector database. Wrappers created elsewhere
+    get them reconstructed under a lock, so that no other thread builds them concurrently.
+    :param docsearch: The vector database wrapper.
+    :param ids: The index positions of the candidates.
+    :return: the dequantized float32 vectors of the candidates.
+    """
+    quantized = _rerank_vectors.get(docsearch)
+    if quantized is None:
+        with _rerank_lock:
+            quantized = _rerank_vectors.get(docsearch)
+            if quantized is None:
+                quantized = reconstruct_rerank_vectors(docsearch.index)
+                _rerank_vectors[docsearch] = quantized
+    codes, scales = quantized
+    return codes[ids].astype(np.float32) / scales[ids, None].astype(np.float32)
+
+
+def _is_ivf_file(index_file: Path) -> bool:
+    """
+    Tells from the header of a faiss index file whether it holds an IVF index. Faiss can only memory map
+    the inverted lists of IVF indexes; flat, HNSW and scalar quantizer indexes are always read into RAM.
+    """
+    with open(index_file, "rb") as f:
+        return f.read(2) == b"Iw"
+
+
+def load_vector_db(embedding_dir: str) -> FAISS:
+    """
+    Reads the persisted vector database from disk.
+    The inverted lists of large IVF indexes and the re-rank vectors are memory mapped, so that their pages
+    are only read when a search touches them and are shared through the page cache by all processes serving
+    the same store. Other index types are read into the memory of each process.
+    :param embedding_dir: The directory with the persisted vector database.
+    :return a vector database wrapper around the embeddings.
+    """
+    embedding_dir_path = Path(embedding_dir)
+    index_file = embedding_dir_path / "index.faiss"
+    if index_file.stat().st_size < cfg.faiss_mmap_threshold or not _is_ivf_file(
+        index_file
+    ):
+        docsearch = FAISS.load_local(embedding_dir, cfg.embeddings)
+    else:
+        logger.info(f"Memory mapping {index_file}")
+        index = faiss.read_index(
+            str(index_file), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        )
+        with open(embedding_dir_path / "index.pkl", "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        docsearch = FAISS(
+            cfg.embeddings.embed_query, index, docstore, index_to_docstore_id
+        )
+    # Inner product indexes hold normalized vectors, so the wrapper has to normalize its queries too
+    docsearch._normalize_L2 = docsearch.index.metric_type == faiss.METRIC_INNER_PRODUCT
+    codes_file = embedding_dir_path / RERANK_CODES_FILE
+    scales_file = embedding_dir_path / RERANK_SCALES_FILE
+    if codes_file.exists() and scales_file.exists():
+        _rerank_vectors[docsearch] = (
+            np.load(codes_file, mmap_mode="r"),
+            np.load(scales_file, mmap_mode="r"),
+        )
+    elif is_pq_coded(docsearch.index):
+        # Built before the index is shared, as reconstructing changes the index
+        logger.warning(f"Re-rank vectors missing in {embedding_dir}, reconstructing")
+        _rerank_vectors[docsearch] = reconstruct_rerank_vectors(docsearch.index)
+    return docsearch
+
 
 def extract_embeddings(texts: List[Document], doc_path: Path) -> FAISS:
     """
     Either saves the vector database embeddings locally or reads them from disk, in case they exist.
     :return a vector database wrapper around the embeddings.
     """
-    embedding_dir = f"{cfg.faiss_persist_directory}/{doc_path.stem}"
-    embedding_dir_path = Path(embedding_dir)
-    if embedding_dir_path.exists() and len(list(embedding_dir_path.glob("*"))) > 0:
-        return FAISS.load_local(embedding_dir, cfg.embeddings)
+    embedding_dir_path = cfg.faiss_persist_directory / doc_path.stem
+    embedding_dir = str(embedding_dir_path)
+    if _has_persisted(embedding_dir_path):
+        return load_vector_db(embedding_dir)
     # if Path(embedding_dir).exists():
     #     shutil.rmtree(embedding_dir, ignore_errors=True)
-    try:
-        docsearch = FAISS.from_documents(texts, cfg.embeddings)
-        FAISS.from_texts
-        docsearch.save_local(embedding_dir)
-        logger.info("Vector database persisted")
-    except Exception as e:
-        logger.error(f"Failed to process {doc_path}: {str(e)}")
-        if "docsearch" in vars() or "docsearch" in globals():
-            docsearch.persist()
+    embedding_cache = load_embedding_cache()
+    cached_count = len(embedding_cache)
+    batch_size = cfg.embedding_batch_size
+    docsearch = None
+    failed_count = 0
+    with ThreadPoolExecutor(max_workers=cfg.embedding_concurrency) as executor:
+        futures = [
+            executor.submit(
+                build_batch_index, texts[start : start + batch_size], embedding_cache
+            )
+            for start in range(0, len(texts), batch_size)
+        ]
+        new_vectors = {}
+        for i, future in enumerate(futures):
+            try:
+                batch_docsearch, batch_vectors = future.result()
+            except Exception as e:
+                logger.error(
+                    "Failed to embed texts %d to %d: %s",
+                    i * batch_size,
+                    min((i + 1) * batch_size, len(texts)) - 1,
+                    e,
+                )
+                failed_count += 1
+                continue
+            new_vectors.update(batch_vectors)
+            if docsearch is None:
+                docsearch = batch_docsearch
+            else:
+                docsearch.merge_from(batch_docsearch)
+    if new_vectors:
+        logger.info(
+            "Embedded %d texts missing from the cache of %d embeddings",
+            len(new_vectors),
+            cached_count,
+        )
+        embedding_cache.update(new_vectors)
+        save_embedding_cache(embedding_cache)
+    if docsearch is None:
+        logger.error(f"Failed to process {doc_path}")
         return None
+    vectors = docsearch.index.reconstruct_n(0, docsearch.index.ntotal)
+    faiss.normalize_L2(vectors)
+    docsearch.index = build_search_index(vectors)
+    docsearch._normalize_L2 = True
+    rerank = is_pq_coded(docsearch.index)
+    if rerank:
+        codes, scales = quantize_vectors(vectors)
+        _rerank_vectors[docsearch] = codes, scales
+    if failed_count > 0:
+        # A partial store would be loaded for good, so let the next start rebuild it
+        logger.warning(
+            "%d of %d batches failed, the vector database is not persisted",
+            failed_count,
+            len(futures),
+        )
+        return docsearch
+    docsearch.save_local(embedding_dir)
+    if rerank:
+        np.save(embedding_dir_path / RERANK_CODES_FILE, codes)
+        np.save(embedding_dir_path / RERANK_SCALES_FILE, scales)
+    logger.info("Vector database persisted")
     return docsearch
 
 
@@ -42,33 +361,42 @@ def load_texts(doc_location: str) -> Tuple[List[str], Path]:
     :return: a tuple with a list of strings and a path.
     """
     doc_path = Path(doc_location)
+    paths = list_txt_files(doc_path)
     texts = []
     failed_count = 0
-    for i, p in enumerate(doc_path.glob("*.txt")):
-        try:
-            logger.info(f"Processed {p}")
-            texts.extend(load_txt(p))
-        except Exception as e:
-            logger.error(f"Cannot process {p} due to {e}")
-            failed_count += 1
+    with ProcessPoolExecutor(max_workers=cfg.load_workers) as executor:
+        futures = [executor.submit(load_txt, p) for p in paths]
+        for p, future in zip(paths, futures):
+            try:
+                texts.extend(future.result())
+                logger.info("Processed %s", p)
+            except Exception as e:
+                logger.error("Cannot process %s due to %s", p, e)
+                failed_count += 1
     logger.info(f"Length of texts: {len(texts)}")
     logger.warning(f"Failed: {failed_count}")
     return texts, doc_path
 
 
-def init_vector_search() -> FAISS:
-    doc_location = os.environ["DOC_LOCATION"]
+def init_vector_search(doc_location: Optional[str] = None) -> FAISS:
+    """
+    Loads the persisted vector database of the documents, building it first if needed.
+    :param doc_location: The document location, DOC_LOCATION by default.
+    :return: the vector database wrapper.
+    """
+    if doc_location is None:
+        doc_location = os.environ["DOC_LOCATION"]
     logger.info(f"Using doc location {doc_location}.")
     doc_path = Path(doc_location)
-    embedding_dir = f"{cfg.faiss_persist_directory}/{doc_path.stem}"
-    embedding_dir_path = Path(embedding_dir)
-    if embedding_dir_path.exists() and len(list(embedding_dir_path.glob("*"))) > 0:
+    embedding_dir_path = cfg.faiss_persist_directory / doc_path.stem
+    embedding_dir = str(embedding_dir_path)
+    if _has_persisted(embedding_dir_path):
         logger.info(f"reading from existing directory")
-        docsearch = FAISS.load_local(embedding_dir, cfg.embeddings)
+        docsearch = load_vector_db(embedding_dir)
         return docsearch
     else:
         logger.warning(f"Cannot find path {embedding_dir} or path is empty.")
         logger.info("Generating vectors")
         texts, doc_path = load_texts(doc_location=doc_location)
-        docsearch = extract_embeddings(texts=texts[: 6400 * 3], doc_path=Path(doc_path))
+        docsearch = extract_embeddings(texts=texts[: 6400 * 3], doc_path=doc_path)
         return docsearch
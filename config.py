@@ -1,28 +1,83 @@
-from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.chat_models import ChatOpenAI
+from langchain.embeddings.base import Embeddings
 from pathlib import Path
 import os
 
 from dotenv import load_dotenv
 
+from retry_embeddings import RetryingOpenAIEmbeddings
+
 load_dotenv()
 
 
+def create_embeddings() -> Embeddings:
+    """
+    Creates the embeddings model. Uses a local sentence-transformers model when HF_EMBEDDING_MODEL is set,
+    batched on the GPU if there is one, and OpenAI embeddings otherwise.
+    :return: the embeddings model.
+    """
+    hf_model = os.getenv("HF_EMBEDDING_MODEL")
+    if not hf_model:
+        return RetryingOpenAIEmbeddings(chunk_size=400)
+    import torch
+    from langchain.embeddings import HuggingFaceEmbeddings
+
+    return HuggingFaceEmbeddings(
+        model_name=hf_model,
+        model_kwargs={"device": "cuda" if torch.cuda.is_available() else "cpu"},
+        encode_kwargs={"batch_size": 128, "normalize_embeddings": True},
+    )
+
+
 class Config:
     chunk_size = 6000
     chunk_overlap = 100
     chunk_separator = "\n\n"
+    # Number of processes loading the text files, None uses all cores
+    load_workers = None
     faiss_persist_directory = Path(os.environ["FAISS_STORE"])
     if not faiss_persist_directory.exists():
         faiss_persist_directory.mkdir()
-    embeddings = OpenAIEmbeddings(chunk_size=400)
+    # IVF indexes larger than this (in bytes) are memory mapped instead of read into RAM.
+    # Faiss reads other index types into RAM whatever their size.
+    faiss_mmap_threshold = 64 * 1024 * 1024
+    # One of "ivfpq", "hnsw", "sq8" (int8 scalar quantizer) or "flat"
+    faiss_index_type = "ivfpq"
+    # IVF-PQ needs enough vectors to train its quantizers, smaller stores use HNSW
+    faiss_ivfpq_min_vectors = 10000
+    faiss_pq_m = 64
+    faiss_pq_nbits = 8
+    faiss_ivf_nprobe = 16
+    faiss_hnsw_m = 32
+    faiss_hnsw_ef_construction = 40
+    faiss_hnsw_ef_search = 64
+    embeddings = create_embeddings()
+    # OpenAI embeds concurrent requests of chunk_size texts. A local model embeds large batches
+    # in a single thread, as concurrent forward passes would compete for the same GPU.
+    local_embeddings = not isinstance(embeddings, RetryingOpenAIEmbeddings)
+    embedding_batch_size = 4096 if local_embeddings else embeddings.chunk_size
+    embedding_concurrency = 1 if local_embeddings else 8
+    # Vectors of already embedded texts, keyed by content hash, reused by later builds
+    embedding_cache_directory = faiss_persist_directory / "embedding_cache"
     model = "gpt-3.5-turbo-16k"
     # model = 'gpt-4'
     llm = ChatOpenAI(model=model, temperature=0)
+    # Only used where the answer is shown as it is generated, as streamed calls report no token usage
+    streaming_llm = ChatOpenAI(model=model, temperature=0, streaming=True)
     chat_hist_location = os.environ["CHAT_HISTORY_LOCATION"]
     history_file = Path(f"{chat_hist_location}/chat_history.txt")
     # To overcome rate limiting erros, please use https://towardsdatascience.com/4-ways-of-question-answering-in-langchain-188c6707cc5a
     search_results = 5
+    # Candidates fetched from product quantized indexes per requested document, re-ranked with their int8 vectors
+    rerank_factor = 4
+    # Maximum context characters (about 13k of the model's 16k tokens) sent in a batched prompt.
+    # A question brings 4 chunks of about chunk_size (6000) characters, so two typical questions fit.
+    batch_char_budget = 52000
+    # Contexts up to this many characters are answered with the stuff chain in a single call,
+    # longer ones are map reduced
+    stuff_char_budget = 40000
+    # Characters of each retrieved document shown as its source
+    source_limit = 512
 
 
 cfg = Config()
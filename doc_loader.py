@@ -4,11 +4,40 @@ from langchain.docstore.document import Document
 from pathlib import Path
 
 from typing import List
+import copy
+import os
 import re
 from config import cfg
 
 from log_factory import logger
 
+_NL_RE = re.compile(r"\n+")
+_PUNCTUATION = ".?!:"
+_SPLITTER = CharacterTextSplitter(
+    chunk_size=cfg.chunk_size,
+    chunk_overlap=cfg.chunk_overlap,
+    separator=cfg.chunk_separator,
+)
+
+
+def last_punct(content: str, start: int, end: int) -> int:
+    """
+    Finds the position after the last punctuation mark in content[start:end].
+    The search runs backwards from end, so it usually stops after a few characters.
+    :return: the position after the punctuation mark or -1, if there is none.
+    """
+    j = max(content.rfind(c, start, end) for c in _PUNCTUATION)
+    return j + 1 if j >= 0 else -1
+
+
+def list_txt_files(doc_path: Path) -> List[Path]:
+    """
+    Lists the text files in a folder, using the file type information returned with the directory entries.
+    :param doc_path: The folder with the text files.
+    """
+    with os.scandir(doc_path) as it:
+        return [Path(e.path) for e in it if e.name.endswith(".txt") and e.is_file()]
+
 
 def load_txt(file_path: Path) -> List[Document]:
     """
@@ -18,9 +47,9 @@ def load_txt(file_path: Path) -> List[Document]:
     """
     loader = TextLoader(file_path=str(file_path), encoding="utf-8")
     doc_list: List[Document] = loader.load()
-    logger.info(f"Length of CSV list: {len(doc_list)}")
+    logger.info("Length of CSV list: %d", len(doc_list))
     for doc in doc_list:
-        doc.page_content = re.sub(r"\n+", "\n", doc.page_content, re.MULTILINE)
+        doc.page_content = _NL_RE.sub("\n", doc.page_content)
 
     return custom_splitter(doc_list)
 
@@ -30,13 +59,30 @@ def split_docs(doc_list: List[Document]) -> List[Document]:
     Splits the documents in smaller chunks from a list of documents.
     :param doc_list: A list of documents.
     """
-    text_splitter = CharacterTextSplitter(
-        chunk_size=cfg.chunk_size,
-        chunk_overlap=cfg.chunk_overlap,
-        separator=cfg.chunk_separator,
-    )
-    texts: List[Document] = text_splitter.split_documents(doc_list)
-    logger.info(f"Length of texts: {len(texts)}")
+    texts: List[Document] = bulk_split(doc_list)
+    logger.info("Length of texts: %d", len(texts))
+    return texts
+
+
+def bulk_split(doc_list: List[Document]) -> List[Document]:
+    """
+    Produces the same chunks as the text splitter, but only runs the splitter on documents longer than a chunk.
+    A shorter document always ends up in a single chunk, so it is emitted directly.
+    :param doc_list: A list of documents.
+    """
+    separator = cfg.chunk_separator
+    texts: List[Document] = []
+    for doc in doc_list:
+        if len(doc.page_content) > cfg.chunk_size:
+            texts.extend(_SPLITTER.split_documents([doc]))
+            continue
+        content = separator.join(
+            s for s in doc.page_content.split(separator) if s != ""
+        ).strip()
+        if content:
+            texts.append(
+                Document(page_content=content, metadata=copy.deepcopy(doc.metadata))
+            )
     return texts
 
 
@@ -47,34 +93,28 @@ def custom_splitter(doc_list: List[Document], part_count: int = 3) -> List[Docum
     res: List[Document] = []
     for doc in doc_list:
         content = doc.page_content
-        i = 0
-        character_size = len(doc.page_content) // part_count - 1
-        part_counter = 0
-        while True:
-            i += character_size
-            temp = content[i - character_size : i]
-            if part_counter == part_count or i > len(content):
+        step = len(content) // part_count - 1
+        if step <= 0:
+            # Too short to split, a negative end would search from the end of the content.
+            content = content.strip()
+            if content:
+                res.append(Document(page_content=content, metadata=doc.metadata))
+            continue
+        start = 0
+        for _ in range(part_count - 1):
+            end_pos = last_punct(content, start, min(start + step, len(content)))
+            if end_pos < 0:
+                logger.error("Could not find punctuation for split")
                 break
-            for j in reversed(range(len(temp))):
-                if temp[j] in [".", "?", "!", ":"]:
-                    j = j + 1
-                    end_pos = i - character_size + j
-                    part_counter += 1
-                    if part_counter == part_count:
-                        temp = content[i - character_size :]
-                        res.append(
-                            Document(page_content=temp.strip(), metadata=doc.metadata)
-                        )
-                    else:
-                        temp = content[i - character_size : end_pos]
-                        res.append(
-                            Document(page_content=temp.strip(), metadata=doc.metadata)
-                        )
-                        i = end_pos
-                    break
-                elif j == 0:
-                    logger.error("Could not find punctuation for split")
-                    break
+            res.append(
+                Document(
+                    page_content=content[start:end_pos].strip(), metadata=doc.metadata
+                )
+            )
+            start = end_pos
+        res.append(
+            Document(page_content=content[start:].strip(), metadata=doc.metadata)
+        )
     return res
 
 
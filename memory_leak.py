@@ -1,28 +1,41 @@
 import tracemalloc, json
 import streamlit as st
 import gc
+import os
+import re
+import functools
 
 
 @st.experimental_singleton
 def init_tracking_object():
-    tracemalloc.start(10)
+    enabled = os.environ.get("LEAK_DEBUG") is not None
+    if enabled:
+        tracemalloc.start(3)
 
-    return {"runs": 0, "tracebacks": {}}
+    return {"runs": 0, "tracebacks": {}, "enabled": enabled}
 
 
 _TRACES = init_tracking_object()
 
+_EXCLUDE_PATTERNS = frozenset(["tornado"])
+_INCLUDE_PATTERNS = frozenset(["streamlit"])
+
+
+@functools.lru_cache(maxsize=None)
+def compile_patterns(patterns: frozenset) -> re.Pattern:
+    """
+    Compiles the patterns into a single alternation, so that each filename is searched only once.
+    """
+    return re.compile("|".join(map(re.escape, sorted(patterns))))
+
 
 def traceback_exclude_filter(patterns, tracebackList):
     """
     Returns False if any provided pattern exists in the filename of the traceback,
     Returns True otherwise.
     """
-    for t in tracebackList:
-        for p in patterns:
-            if p in t.filename:
-                return False
-        return True
+    patterns_re = compile_patterns(frozenset(patterns))
+    return not any(patterns_re.search(t.filename) for t in tracebackList)
 
 
 def traceback_include_filter(patterns, tracebackList):
@@ -30,11 +43,8 @@ def traceback_include_filter(patterns, tracebackList):
     Returns True if any provided pattern exists in the filename of the traceback,
     Returns False otherwise.
     """
-    for t in tracebackList:
-        for p in patterns:
-            if p in t.filename:
-                return True
-    return False
+    patterns_re = compile_patterns(frozenset(patterns))
+    return any(patterns_re.search(t.filename) for t in tracebackList)
 
 
 def check_for_leaks(diff):
@@ -79,7 +89,10 @@ def compare_snapshots():
     Compares two consecutive snapshots and tracks if the same traceback can be found
     in the diff. If a traceback consistently appears during runs, it's a good indicator
     for a memory leak.
+    Does nothing unless the LEAK_DEBUG environment variable is set.
     """
+    if not _TRACES["enabled"]:
+        return
     snapshot = tracemalloc.take_snapshot()
     if "snapshot" in _TRACES:
         diff = snapshot.compare_to(_TRACES["snapshot"], "lineno")
@@ -87,8 +100,8 @@ def compare_snapshots():
             d
             for d in diff
             if d.count_diff > 0
-            and traceback_exclude_filter(["tornado"], d.traceback)
-            and traceback_include_filter(["streamlit"], d.traceback)
+            and traceback_exclude_filter(_EXCLUDE_PATTERNS, d.traceback)
+            and traceback_include_filter(_INCLUDE_PATTERNS, d.traceback)
         ]
         check_for_leaks(diff)
 
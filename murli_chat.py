@@ -1,32 +1,36 @@
-from typing import List, Tuple
+from typing import List
 from langchain.docstore.document import Document
-from pathlib import Path
 from langchain.vectorstores import FAISS
 
 import streamlit as st
 
+import asyncio
 import os
 
-from doc_loader import load_txt
 from config import cfg
 from log_factory import logger
 
-from dotenv import load_dotenv
-
 from chat_factory import init_vector_search
-from question_service import search_and_combine
+from question_service import asearch_and_combine, extract_source_texts
 
-load_dotenv()
+SESSION_HISTORY = "SESSION_HISTORY"
 
 
 def write_history(question):
     """
-    Writes the question into a local history file.
+    Writes the question into a local history file, unless it is already there.
     :param question: The text to be written to the local history file.
     """
+    question = question.strip()
     if len(question) > 0:
+        if SESSION_HISTORY not in st.session_state:
+            st.session_state[SESSION_HISTORY] = set(read_history())
+        written_questions = st.session_state[SESSION_HISTORY]
+        if question in written_questions:
+            return
         with open(cfg.history_file, "a") as f:
             f.write(f"{question}\n")
+        written_questions.add(question)
 
 
 @st.cache_data()
@@ -37,7 +41,7 @@ def read_history() -> List[str]:
     """
     history_list = [""]
     with open(cfg.history_file, "r") as f:
-        history_list.extend(list(set([l for l in f.readlines() if len(l.strip()) > 0])))
+        history_list.extend(dict.fromkeys(l.strip() for l in f if l.strip()))
     return history_list
 
 
@@ -51,16 +55,19 @@ def process_user_question(
     :param user_question: The question the user has typed.
     """
     if user_question:
-        response, similar_texts, similar_metadata = search_and_combine(
-            docsearch=docsearch,
-            user_question=user_question,
-            chain_type=chain_type,
-            context_size=context_size,
+        response, similar_docs = asyncio.run(
+            asearch_and_combine(
+                docsearch=docsearch,
+                user_question=user_question,
+                chain_type=chain_type,
+                context_size=context_size,
+            )
         )
         st.markdown(response)
-        if len(similar_texts) > 0:
+        if len(similar_docs) > 0:
             write_history(user_question)
             st.text("Similar entries (Vector database results)")
+            similar_texts, _ = extract_source_texts(similar_docs)
             st.write(similar_texts)
         else:
             st.warning("This answer is unrelated to our context.")
@@ -72,12 +79,12 @@ def create_chain_type(chain_key: str) -> str:
     map_reduce: It separates texts into batches (as an example, you can define batch size in llm=OpenAI(batch_size=5)), feeds each batch with the question to LLM separately, and comes up with the final answer based on the answers from each batch.
     refine : It separates texts into batches, feeds the first batch to LLM, and feeds the answer and the second batch to LLM. It refines the answer by going through all the batches.
     map-rerank: It separates texts into batches, feeds each batch to LLM, returns a score of how fully it answers the question, and comes up with the final answer based on the high-scored answers from each batch.
-    chain_type="stuff" uses ALL of the text from the documents in the prompt. It actually doesn’t work with our example because it exceeds the token limit and causes rate-limiting errors
+    chain_type="stuff" uses ALL of the text from the documents in the prompt, in a single LLM call. Whatever the selection, it is used when the documents total at most cfg.stuff_char_budget characters, and map_reduce replaces it when they are longer.
     """
-    default_chain = "map_reduce"
+    default_chain = "stuff"
     chain_type: str = st.selectbox(
         "Which chain type would you like to use?",
-        (default_chain, "refine", "map_rerank", "stuff"),
+        (default_chain, "map_reduce", "refine", "map_rerank"),
         key=chain_key,
     )
     if chain_type is None:
@@ -137,25 +144,14 @@ def init_streamlit(docsearch: FAISS):
                 )
 
 
-def load_texts(doc_location: str) -> Tuple[List[str], Path]:
+@st.cache_resource(show_spinner=False)
+def load_docsearch(doc_location: str) -> FAISS:
     """
-    Loads the texts of the CSV file and concatenates all texts in a single list.
+    Loads the vector database once per document location and shares it across all Streamlit reruns and sessions.
     :param doc_location: The document location.
-    :return: a tuple with a list of strings and a path.
+    :return: the vector database wrapper.
     """
-    doc_path = Path(doc_location)
-    texts = []
-    failed_count = 0
-    for i, p in enumerate(doc_path.glob("*.txt")):
-        try:
-            logger.info(f"Processed {p}")
-            texts.extend(load_txt(p))
-        except Exception as e:
-            logger.error(f"Cannot process {p} due to {e}")
-            failed_count += 1
-    logger.info(f"Length of texts: {len(texts)}")
-    logger.warning(f"Failed: {failed_count}")
-    return texts, doc_path
+    return init_vector_search(doc_location)
 
 
 def main(doc_location: str = "onepoint_chat"):
@@ -165,7 +161,7 @@ def main(doc_location: str = "onepoint_chat"):
     creates the vector database and initializes the user interface.
     :param doc_location: The location of the CSV files
     """
-    docsearch = init_vector_search()
+    docsearch = load_docsearch(doc_location)
     init_streamlit(docsearch=docsearch)
 
 
@@ -1,14 +1,144 @@
 import chainlit as cl
+from langchain.callbacks.base import AsyncCallbackHandler
+from langchain.docstore.document import Document
+from langchain.vectorstores import FAISS
 
-from dotenv import load_dotenv
+from typing import List, Optional, Set
+import asyncio
+import functools
 
 from log_factory import logger
+from config import cfg
 from chat_factory import init_vector_search
-from question_service import extract_sources, search_and_combine
-
-load_dotenv()
+from question_service import (
+    extract_source_texts,
+    fast_similarity_search,
+    process_questions,
+)
 
 SESSION_DOCSEARCH = "SESSION_DOCSEARCH"
+CONTEXT_SIZE = 4
+BATCH_WINDOW_MS = 50
+BATCH_SIZE = 3
+
+
+def _context_chars(item) -> int:
+    similar_docs, *_ = item
+    return sum(len(d.page_content) for d in similar_docs)
+
+
+class StreamingMessageHandler(AsyncCallbackHandler):
+    """
+    Streams the LLM tokens into a chainlit message as they are generated.
+    """
+
+    def __init__(self, msg: cl.Message):
+        self.msg = msg
+        self.streamed = False
+
+    async def on_llm_new_token(self, token: str, **kwargs) -> None:
+        self.streamed = True
+        await self.msg.stream_token(token)
+
+
+class BatchQueue:
+    """
+    Collects the questions which arrive within a short window, across all chat sessions,
+    and answers them with a single LLM call.
+    A question which arrives on its own is answered with its tokens streamed to the handler.
+    """
+
+    def __init__(self, window_ms: int = BATCH_WINDOW_MS, max_size: int = BATCH_SIZE):
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker: Optional[asyncio.Task] = None
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def submit(
+        self,
+        similar_docs: List[Document],
+        question: str,
+        handler: StreamingMessageHandler,
+    ) -> str:
+        """
+        Queues the question and waits for its answer.
+        :param similar_docs: The documents retrieved from the vector database for the question.
+        :param question: The user question.
+        :param handler: Receives the answer tokens when the question is not batched.
+        :return: The LLM response.
+        """
+        if self.worker is None or self.worker.done():
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((similar_docs, question, handler, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        pending = None
+        while True:
+            item = pending or await self.queue.get()
+            pending = None
+            batch = [item]
+            batch_chars = _context_chars(item)
+            # Only wait for more questions if one with a similar context could still fit.
+            deadline = loop.time() + self.window
+            while (
+                len(batch) < self.max_size
+                and batch_chars <= cfg.batch_char_budget / 2
+            ):
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                item_chars = _context_chars(item)
+                if batch_chars + item_chars > cfg.batch_char_budget:
+                    pending = item
+                    break
+                batch.append(item)
+                batch_chars += item_chars
+            # Answer in a separate task, so that other sessions are not held up.
+            task = asyncio.create_task(self._answer_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _answer_batch(self, batch):
+        try:
+            results = await self._answer(batch)
+        except Exception as e:
+            logger.error("Failed to answer %d questions: %s", len(batch), e)
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (*_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _answer(self, batch) -> List[str]:
+        similar_docs_list = [similar_docs for similar_docs, *_ in batch]
+        questions = [question for _, question, *_ in batch]
+        handlers = [[handler] for *_, handler, _ in batch]
+        logger.info("Answering %d questions in one batch", len(questions))
+        return await process_questions(similar_docs_list, questions, handlers)
+
+
+batch_queue = BatchQueue()
+
+
+@functools.lru_cache(maxsize=1)
+def load_docsearch() -> FAISS:
+    """
+    Loads the vector database once per process and shares it across all chat sessions.
+    :return: the vector database wrapper.
+    """
+    return init_vector_search()
+
 
 def process_index_file():
     from chainlit import server
@@ -16,16 +146,15 @@ def process_index_file():
 
     build_path = Path(server.build_dir)
     logger.info("build_path: %s", build_path)
-    if build_path.exists():
-        for p in build_path.glob("*.html"):
-            if p.name == "index.html":
-                with open(p) as f:
-                    index_contexts = f.read()
-                    index_contexts = index_contexts.replace("\"/assets/", "\"assets/")
-                    logger.info(index_contexts)
-                with open(p, 'w') as f:
-                    f.write(index_contexts)
-                    logger.info(f"Updated index: \n\n{index_contexts}")
+    p = build_path / "index.html"
+    if p.exists():
+        with open(p) as f:
+            index_contexts = f.read()
+            index_contexts = index_contexts.replace("\"/assets/", "\"assets/")
+            logger.info(index_contexts)
+        with open(p, 'w') as f:
+            f.write(index_contexts)
+            logger.info(f"Updated index: \n\n{index_contexts}")
 
 
 
@@ -34,7 +163,7 @@ async def main():
     process_index_file()
     logger.info("Chat started")
     
-    docsearch = init_vector_search()
+    docsearch = load_docsearch()
     cl.user_session.set(SESSION_DOCSEARCH, docsearch)
     await cl.Message(content="Murli chat is up and running!").send()
 
@@ -42,41 +171,25 @@ async def main():
 @cl.on_message
 async def main(message: str):
     docsearch = cl.user_session.get(SESSION_DOCSEARCH)
-    msg_wait = cl.Message(content="")
-    await msg_wait.send()
-
-    response, similar_texts, similar_metadata = search_and_combine(
-        docsearch=docsearch,
-        user_question=message,
-        chain_type="stuff",
-        context_size=4,
+    similar_docs = await asyncio.to_thread(
+        fast_similarity_search, docsearch, message, k=CONTEXT_SIZE
     )
 
-    # Source message
-    await display_sources(similar_texts, similar_metadata)
-
-    # Create the streaming effect.
-    msg = cl.Message(content="")
-    chunk_size = 3
-    for token in [
-        response[i : i + chunk_size] for i in range(0, len(response), chunk_size)
-    ]:
-        await msg.stream_token(token)
-    await msg.send()
-
-
-async def display_sources(similar_texts, similar_metadata):
-    sources = extract_sources(similar_metadata)
-    found_sources = []
-    elements = []
+    similar_texts, sources = extract_source_texts(similar_docs)
     logger.info(f"similar_texts: {len(similar_texts)} similar sources: {len(sources)}")
-    for text, source in zip(similar_texts, sources):
-        found_sources.append(source)
-        elements.append(cl.Text(name=source, content=text, display="side"))
-
-    await cl.Message(
-        content=f"\nSources: {', '.join(found_sources)}", elements=elements
-    ).send()
+    elements = [
+        cl.Text(name=source, content=text, display="side")
+        for text, source in zip(similar_texts, sources)
+    ]
+
+    # The answer is streamed into a single message which also carries the sources.
+    msg = cl.Message(content="", elements=elements)
+    handler = StreamingMessageHandler(msg)
+    response = await batch_queue.submit(similar_docs, message, handler)
+    if not handler.streamed:
+        await msg.stream_token(response)
+    await msg.stream_token(f"\n\nSources: {', '.join(sources)}")
+    await msg.send()
 
 
 if __name__ == "__main__":
@@ -1,62 +1,223 @@
+import asyncio
+import functools
+import json
+import ntpath
 import re
+import faiss
+import numpy as np
 from langchain.docstore.document import Document
 from langchain.vectorstores import FAISS
 from langchain.chains.question_answering import load_qa_chain
 from langchain.callbacks import get_openai_callback
+from langchain.callbacks.manager import Callbacks
 
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 
 from log_factory import logger
 
 from config import cfg
+from chat_factory import is_pq_coded, rerank_candidates
+
+BATCH_PROMPT = """Answer each of the following {count} questions separately, using only the context given with the question.
+Reply with a JSON list of {count} strings, one answer per question in the same order, and nothing else.
+
+{questions}"""
+
+# Chat models often wrap JSON replies in a Markdown code block
+_CODE_FENCE_RE = re.compile(r"^\s*```(?:json)?|```\s*$")
 
 
 def enhance_question(orig_question: str) -> str:
     return f"According to the context: {orig_question}"
 
 
-def process_question(
-    similar_docs: List[Document], user_question: str, chain_type: str = "map_reduce"
+@functools.lru_cache(maxsize=8)
+def _get_chain(chain_type: str, streaming: bool = False):
+    """
+    Builds the question answering chain once per chain type. The LLM is a singleton, so the chain can be reused.
+    Streaming chains emit their tokens to the callbacks, but OpenAI reports no token usage for them.
+    """
+    return load_qa_chain(
+        cfg.streaming_llm if streaming else cfg.llm, chain_type=chain_type
+    )
+
+
+def fast_similarity_search(docsearch: FAISS, query: str, k: int) -> List[Document]:
+    """
+    Searches the index for the k documents most similar to the query.
+    Product quantized indexes score with coarse codes, so k * cfg.rerank_factor candidates are fetched
+    from them and re-ranked with a single matrix product over their int8 vectors, which are much closer
+    to the original vectors. Other indexes already score precisely enough and are used as they are.
+    Inner product indexes are ranked by the cosine similarity with the normalized query.
+    :param docsearch: The reference to the vector database object
+    :param query: The text to search for.
+    :param k: The number of documents to return.
+    :return: the k most similar documents, the most similar first.
+    """
+    query_vector = np.asarray(docsearch.embedding_function(query), dtype=np.float32)
+    inner_product = docsearch.index.metric_type == faiss.METRIC_INNER_PRODUCT
+    if inner_product:
+        query_vector = query_vector / np.linalg.norm(query_vector)
+    if not is_pq_coded(docsearch.index):
+        _, ids = docsearch.index.search(query_vector.reshape(1, -1), k)
+        return [
+            docsearch.docstore.search(docsearch.index_to_docstore_id[int(i)])
+            for i in ids[0]
+            if i >= 0
+        ]
+    n_candidates = min(k * cfg.rerank_factor, docsearch.index.ntotal)
+    _, ids = docsearch.index.search(query_vector.reshape(1, -1), n_candidates)
+    ids = ids[0][ids[0] >= 0]
+    candidates = rerank_candidates(docsearch, ids)
+    if inner_product:
+        distances = -(candidates @ query_vector)
+    else:
+        # Squared L2 distances, leaving out the |q|^2 term which is the same for all candidates
+        distances = np.einsum("ij,ij->i", candidates, candidates) - 2 * (
+            candidates @ query_vector
+        )
+    top = np.argpartition(distances, k - 1)[:k] if len(ids) > k else np.arange(len(ids))
+    top = top[np.argsort(distances[top])]
+    return [
+        docsearch.docstore.search(docsearch.index_to_docstore_id[int(i)])
+        for i in ids[top]
+    ]
+
+
+async def process_question(
+    similar_docs: List[Document],
+    user_question: str,
+    chain_type: str = "stuff",
+    callbacks: Callbacks = None,
 ) -> str:
     """
     Sends the question to the LLM.
+    Documents which fit into a single prompt are always stuffed into it, saving the extra calls of the other chain types.
+    Documents which do not fit are never stuffed, but map reduced instead.
     :param similar_docs: A list of documents with the documents retrieved from the vector database.
     :param user_question: A user question
+    :param callbacks: Callback handlers which receive the LLM tokens as they are generated, if given.
+    Only the stuff chain streams, the intermediate answers of the other chains would be mixed into the tokens.
     :return: The result computed by the LLM.
     """
     # See https://towardsdatascience.com/4-ways-of-question-answering-in-langchain-188c6707cc5a
-    chain = load_qa_chain(cfg.llm, chain_type=chain_type)
-    similar_texts = [d.page_content for d in similar_docs]
+    context_chars = sum(len(d.page_content) for d in similar_docs)
+    fits = context_chars <= cfg.stuff_char_budget
+    if fits != (chain_type == "stuff"):
+        fitting_chain_type = "stuff" if fits else "map_reduce"
+        logger.info(
+            "Using %s instead of %s for %d context characters",
+            fitting_chain_type,
+            chain_type,
+            context_chars,
+        )
+        chain_type = fitting_chain_type
+    if chain_type != "stuff":
+        callbacks = None
+    chain = _get_chain(chain_type, streaming=callbacks is not None)
     with get_openai_callback() as callback:
-        response = chain.run(
-            input_documents=similar_docs, question=enhance_question(user_question)
+        response = await chain.arun(
+            input_documents=similar_docs,
+            question=enhance_question(user_question),
+            callbacks=callbacks,
         )
         logger.info(callback)
-    similar_metadata = [d.metadata for d in similar_docs]
-    return response, similar_texts, similar_metadata
+    return response
 
 
-def search_and_combine(
+async def process_questions(
+    similar_docs_list: List[List[Document]],
+    user_questions: List[str],
+    callbacks_list: Optional[List[Callbacks]] = None,
+) -> List[str]:
+    """
+    Sends several questions, each with its own context, to the LLM in a single call.
+    Falls back to one call per question for a single question, if the contexts are too long
+    or if the reply cannot be parsed.
+    :param similar_docs_list: The documents retrieved from the vector database for each question.
+    :param user_questions: The user questions.
+    :param callbacks_list: The callback handlers of each question, used when it is asked on its own.
+    :return: The answers in the order of the questions.
+    """
+    if callbacks_list is None:
+        callbacks_list = [None] * len(user_questions)
+    context_chars = sum(len(d.page_content) for docs in similar_docs_list for d in docs)
+    if len(user_questions) > 1 and context_chars <= cfg.batch_char_budget:
+        blocks = []
+        for i, (similar_docs, user_question) in enumerate(
+            zip(similar_docs_list, user_questions), 1
+        ):
+            context = "\n\n".join(d.page_content for d in similar_docs)
+            blocks.append(
+                f"Question {i}: {enhance_question(user_question)}\nContext {i}:\n{context}"
+            )
+        prompt = BATCH_PROMPT.format(
+            count=len(user_questions), questions="\n\n".join(blocks)
+        )
+        with get_openai_callback() as callback:
+            response = await cfg.llm.apredict(prompt)
+            logger.info(callback)
+        try:
+            answers = json.loads(_CODE_FENCE_RE.sub("", response))
+            if isinstance(answers, list) and len(answers) == len(user_questions):
+                return [str(a) for a in answers]
+        except json.JSONDecodeError:
+            pass
+        logger.warning("Could not parse the batched answers, asking one by one")
+    return await asyncio.gather(
+        *[
+            process_question(similar_docs, user_question, "stuff", callbacks)
+            for similar_docs, user_question, callbacks in zip(
+                similar_docs_list, user_questions, callbacks_list
+            )
+        ]
+    )
+
+
+async def asearch_and_combine(
     docsearch: FAISS,
     user_question: str,
     chain_type: str = "stuff",
     context_size: int = 4,
-):
-    similar_docs: List[Document] = docsearch.similarity_search(
-        user_question, k=context_size
-    )
-    response, similar_texts, similar_metadata = process_question(
-        similar_docs, user_question, chain_type
+) -> Tuple[str, List[Document]]:
+    """
+    Retrieves the documents most similar to the question and sends them with the question to the LLM.
+    The search runs in a worker thread so that the event loop is not blocked.
+    :return: The LLM response and the retrieved documents.
+    """
+    similar_docs: List[Document] = await asyncio.to_thread(
+        fast_similarity_search, docsearch, user_question, k=context_size
     )
-    return response, similar_texts, similar_metadata
+    response = await process_question(similar_docs, user_question, chain_type)
+    return response, similar_docs
+
+
+@functools.lru_cache(maxsize=4096)
+def source_name(source: str) -> str:
+    """
+    Strips the directory and the .txt extension from a source path, Windows or POSIX.
+    The same files are cited over and over, so the names are cached.
+    """
+    return ntpath.basename(source).removesuffix(".txt")
 
 
 def extract_sources(similar_metadata: List[Dict]):
-    sources = []
-    for metadata in similar_metadata:
-        source = metadata["source"]
-        sources.append(re.sub(r".+[\\/](.+)\.txt", r"\1", source))
-    return sources
+    return [source_name(metadata["source"]) for metadata in similar_metadata]
+
+
+def extract_source_texts(
+    similar_docs: List[Document],
+) -> Tuple[List[str], List[str]]:
+    """
+    Prepares the retrieved documents for display, in a single pass.
+    :param similar_docs: The documents retrieved from the vector database.
+    :return: the texts cut to the configured source limit and the source names.
+    """
+    similar_texts, sources = [], []
+    for d in similar_docs:
+        similar_texts.append(d.page_content[: cfg.source_limit])
+        sources.append(source_name(d.metadata["source"]))
+    return similar_texts, sources
 
 
 if __name__ == "__main__":
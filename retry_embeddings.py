@@ -0,0 +1,73 @@
+import logging
+from typing import List, Optional
+
+import openai
+from langchain.embeddings.openai import OpenAIEmbeddings
+from tenacity import (
+    before_sleep_log,
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+from tenacity.wait import wait_base
+
+from log_factory import logger
+
+
+class wait_retry_after(wait_base):
+    """
+    Waits as long as the Retry-After header of the failed request asks for.
+    Uses the fallback strategy when the header is missing.
+    """
+
+    def __init__(self, fallback: wait_base):
+        self.fallback = fallback
+
+    def __call__(self, retry_state) -> float:
+        exception = retry_state.outcome.exception()
+        retry_after = getattr(exception, "headers", {}).get("retry-after")
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return self.fallback(retry_state)
+
+
+retry_on_rate_limit = retry(
+    reraise=True,
+    wait=wait_retry_after(wait_exponential_jitter(initial=1, max=60)),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception_type(openai.error.RateLimitError),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+)
+
+
+class RetryingOpenAIEmbeddings(OpenAIEmbeddings):
+    """
+    OpenAI embeddings which back off on rate limit errors instead of failing the whole index build.
+    langchain's own retries are switched off, so that the Retry-After header is honoured from the first error.
+    """
+
+    max_retries: int = 1
+
+    @retry_on_rate_limit
+    def embed_documents(
+        self, texts: List[str], chunk_size: Optional[int] = 0
+    ) -> List[List[float]]:
+        return super().embed_documents(texts, chunk_size)
+
+    @retry_on_rate_limit
+    async def aembed_documents(
+        self, texts: List[str], chunk_size: Optional[int] = 0
+    ) -> List[List[float]]:
+        return await super().aembed_documents(texts, chunk_size)
+
+    @retry_on_rate_limit
+    def embed_query(self, text: str) -> List[float]:
+        return super().embed_query(text)
+
+    @retry_on_rate_limit
+    async def aembed_query(self, text: str) -> List[float]:
+        return await super().aembed_query(text)